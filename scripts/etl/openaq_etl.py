@@ -5,8 +5,12 @@ Amazon Sustainability Data Initiative (ASDI) Integration
 This script fetches real-time air quality data from OpenAQ API
 and updates the climate_inequality_regions table in Supabase.
 
+The ASDI archive (s3://openaq-data-archive) is partitioned by location ID
+as daily csv.gz files with no country column, so country-level fetches go
+through the REST API rather than reading the archive directly.
+
 Requirements:
-    pip install requests python-dotenv psycopg2-binary
+    pip install requests requests-cache diskcache orjson numpy python-dotenv psycopg2-binary
 
 Usage:
     python scripts/etl/openaq_etl.py
@@ -17,19 +21,34 @@ Environment Variables:
     SUPABASE_DB_URL - PostgreSQL connection string (optional, for direct DB)
 """
 
+import diskcache
+import logging
+import math
 import os
 import requests
+import requests_cache
 import json
+import numpy as np
+import orjson
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Sequence, Tuple
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # OpenAQ API Configuration
 OPENAQ_API_BASE = "https://api.openaq.org/v2"
 
+# Measurements per page, and a cap on pages fetched per query
+OPENAQ_PAGE_LIMIT = 10000
+OPENAQ_MAX_PAGES = 10
+
 # Country mapping - ISO codes to names
 COUNTRIES = {
     'DEU': 'Germany',
@@ -46,27 +65,136 @@ COUNTRIES = {
     'PRT': 'Portugal',
 }
 
+# OpenAQ parameters to fetch, with display labels
+PARAMETERS = {
+    'pm25': 'PM2.5',
+    'no2': 'NO2',
+}
+
+# On-disk cache for OpenAQ GET responses, keyed by URL and query params
+OPENAQ_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'openaq_cache')
+OPENAQ_CACHE_EXPIRE = timedelta(hours=6)
+
+# On-disk cache of per-(country, parameter, window) averages, expiry in seconds
+RESULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.etl_cache')
+RESULT_CACHE_EXPIRE = 12 * 60 * 60
+
+# Separator line for run start/end log banners
+BANNER = '=' * 60
+
+# Concurrent country fetches - kept low to stay within OpenAQ rate limits
+MAX_WORKERS = 8
+
+def trimmed_mean(arr: np.ndarray) -> float:
+    """
+    Mean of a non-empty float64 array with the top/bottom 5% removed
+    
+    The cut points are exact order statistics, so the full sample is needed;
+    a streaming accumulator could only approximate them.
+    """
+    n = arr.size
+    
+    # Too few readings to trim - average directly and skip the NumPy machinery
+    if n <= 10:
+        return math.fsum(arr.tolist()) / n
+    
+    # np.partition places both cut points in O(N) without a full sort
+    trim_count = max(1, n // 20)
+    trimmed = np.partition(arr, [trim_count, n - trim_count - 1])[trim_count:n - trim_count]
+    
+    # ndarray.mean() sums pairwise, keeping rounding error at O(log N)
+    return float(trimmed.mean())
+
 class OpenAQETL:
+    # Query params shared by every measurements request
+    _PARAM_TEMPLATE = (
+        ('limit', OPENAQ_PAGE_LIMIT),
+        ('order_by', 'datetime'),
+    )
+    
     def __init__(self):
         self.supabase_url = os.getenv('SUPABASE_URL')
         self.supabase_key = os.getenv('SUPABASE_SERVICE_KEY')
         
         if not self.supabase_url or not self.supabase_key:
             raise ValueError("Missing SUPABASE_URL or SUPABASE_SERVICE_KEY environment variables")
+        
+        # Supabase auth headers are kept off the session so they never reach OpenAQ
+        self.supabase_headers = {
+            'apikey': self.supabase_key,
+            'Authorization': f'Bearer {self.supabase_key}',
+            'Content-Type': 'application/json',
+            'Prefer': 'return=representation'
+        }
+        
+        self.session = self._create_session()
+        self.result_cache = diskcache.Cache(RESULT_CACHE_PATH)
     
-    def fetch_country_air_quality(self, country_code: str, days_back: int = 7) -> Dict[str, Optional[float]]:
+    def _create_session(self) -> requests.Session:
+        """Create a pooled session shared by all OpenAQ and Supabase requests"""
+        # Only GETs (OpenAQ) are cached; Supabase writes always go through
+        session = requests_cache.CachedSession(
+            OPENAQ_CACHE_PATH,
+            backend='sqlite',
+            expire_after=OPENAQ_CACHE_EXPIRE,
+            allowable_methods=['GET']
+        )
+        
+        # Keep-alive pool with retries on rate limiting and transient server errors.
+        # requests is HTTP/1.1 only, but each worker reuses its connection, so a
+        # run pays at most one TLS handshake per concurrent worker per host
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=None,
+                raise_on_status=False
+            )
+        )
+        session.mount('https://', adapter)
+        
+        return session
+    
+    def close(self):
+        """Close pooled connections and the result cache"""
+        self.session.close()
+        self.result_cache.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    @staticmethod
+    def _date_range(end_date: datetime, days_back: int) -> Tuple[str, str]:
+        """Format the (date_from, date_to) query window ending at end_date"""
+        start_date = end_date - timedelta(days=days_back)
+        return start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')
+    
+    def fetch_country_air_quality(
+        self,
+        country_code: str,
+        days_back: int = 7,
+        date_range: Optional[Tuple[str, str]] = None
+    ) -> Dict[str, Optional[float]]:
         """
         Fetch average PM2.5 and NO2 values for a country from OpenAQ
         
         Args:
             country_code: ISO 3166-1 alpha-3 country code
             days_back: Number of days to look back for data
+            date_range: Precomputed (date_from, date_to) window, overrides days_back
             
         Returns:
             Dictionary with avg_pm25 and avg_no2 values
         """
-        end_date = datetime.utcnow()
-        start_date = end_date - timedelta(days=days_back)
+        if date_range is None:
+            date_range = self._date_range(datetime.utcnow(), days_back)
+        date_from, date_to = date_range
         
         result = {
             'avg_pm25': None,
@@ -74,117 +202,223 @@ class OpenAQETL:
             'measurement_count': 0
         }
         
-        # Fetch PM2.5 data
+        # PM2.5 and NO2 come back from a single query
         try:
-            pm25_data = self._fetch_parameter_data(
-                country_code, 
-                'pm25', 
-                start_date, 
-                end_date
-            )
-            if pm25_data:
-                result['avg_pm25'] = self._calculate_average(pm25_data)
-                print(f"  ✓ {country_code} PM2.5: {result['avg_pm25']:.2f} µg/m³ ({len(pm25_data)} measurements)")
+            averages = self._fetch_parameter_averages(country_code, date_from, date_to)
         except Exception as e:
-            print(f"  ✗ Error fetching PM2.5 for {country_code}: {str(e)}")
+            logger.error("  ✗ Error fetching air quality for %s: %s", country_code, e)
+            return result
         
-        # Fetch NO2 data
-        try:
-            no2_data = self._fetch_parameter_data(
-                country_code, 
-                'no2', 
-                start_date, 
-                end_date
-            )
-            if no2_data:
-                result['avg_no2'] = self._calculate_average(no2_data)
-                print(f"  ✓ {country_code} NO2: {result['avg_no2']:.2f} µg/m³ ({len(no2_data)} measurements)")
-        except Exception as e:
-            print(f"  ✗ Error fetching NO2 for {country_code}: {str(e)}")
+        for parameter, (average, count) in averages.items():
+            if count:
+                result[f'avg_{parameter}'] = average
+                logger.info("  ✓ %s %s: %.2f µg/m³ (%d measurements)", country_code, PARAMETERS[parameter], average, count)
         
         return result
     
-    def _fetch_parameter_data(
+    def _fetch_parameter_averages(
+        self,
+        country_code: str,
+        date_from: str,
+        date_to: str
+    ) -> Dict[str, Tuple[Optional[float], int]]:
+        """Average every parameter for a country, reusing results stored by earlier runs"""
+        keys = {parameter: f"{country_code}:{parameter}:{date_from}:{date_to}" for parameter in PARAMETERS}
+        
+        averages = {}
+        for parameter, key in keys.items():
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                averages[parameter] = cached
+        
+        missing = [parameter for parameter in PARAMETERS if parameter not in averages]
+        if not missing:
+            return averages
+        
+        measurements = self._fetch_measurements(country_code, missing, date_from, date_to)
+        
+        # A window ending today can still gain measurements; closed windows never change
+        is_open = date_to >= datetime.utcnow().strftime('%Y-%m-%d')
+        
+        for parameter in missing:
+            data = measurements[parameter]
+            if not data.size:
+                averages[parameter] = (None, 0)
+                continue
+            
+            averages[parameter] = (self._calculate_average(data), int(data.size))
+            self.result_cache.set(keys[parameter], averages[parameter], expire=RESULT_CACHE_EXPIRE if is_open else None)
+        
+        return averages
+    
+    def _fetch_measurements(
         self, 
         country_code: str, 
-        parameter: str, 
-        start_date: datetime, 
-        end_date: datetime
-    ) -> List[float]:
-        """Fetch measurements for a specific parameter"""
+        parameters: Sequence[str], 
+        date_from: str, 
+        date_to: str
+    ) -> Dict[str, np.ndarray]:
+        """Fetch measurements for several parameters in one paginated query"""
         url = f"{OPENAQ_API_BASE}/measurements"
         
-        params = {
-            'country': country_code,
-            'parameter': parameter,
-            'date_from': start_date.strftime('%Y-%m-%d'),
-            'date_to': end_date.strftime('%Y-%m-%d'),
-            'limit': 10000,
-            'order_by': 'datetime'
-        }
-        
-        response = requests.get(url, params=params, timeout=30)
-        response.raise_for_status()
+        params = (
+            ('country', country_code),
+            *(('parameter', parameter) for parameter in parameters),
+            ('date_from', date_from),
+            ('date_to', date_to),
+            *self._PARAM_TEMPLATE
+        )
         
-        data = response.json()
-        measurements = []
+        pages = {parameter: [] for parameter in parameters}
         
-        if 'results' in data:
-            for result in data['results']:
-                if 'value' in result and result['value'] is not None:
-                    measurements.append(float(result['value']))
+        for page in range(1, OPENAQ_MAX_PAGES + 1):
+            response = self.session.get(url, params=[*params, ('page', page)], timeout=30)
+            response.raise_for_status()
+            
+            data = orjson.loads(response.content)
+            results = data.get('results', [])
+            
+            # Build float64 arrays straight from the parsed records, no list of boxed floats
+            for parameter, arrays in pages.items():
+                arrays.append(np.fromiter(
+                    (
+                        result['value'] for result in results
+                        if result.get('parameter') == parameter and result.get('value') is not None
+                    ),
+                    dtype=np.float64
+                ))
+            
+            # A short page, or reaching meta.found, means there is nothing left
+            found = data.get('meta', {}).get('found')
+            if len(results) < OPENAQ_PAGE_LIMIT or (isinstance(found, int) and page * OPENAQ_PAGE_LIMIT >= found):
+                break
+        else:
+            logger.warning(
+                "  ⚠ %s %s: stopped after %d pages, results truncated",
+                country_code, ', '.join(parameters), OPENAQ_MAX_PAGES
+            )
         
-        return measurements
+        return {parameter: np.concatenate(arrays) for parameter, arrays in pages.items()}
     
-    def _calculate_average(self, values: List[float]) -> Optional[float]:
+    def _calculate_average(self, values: Sequence[float]) -> Optional[float]:
         """Calculate average, filtering outliers"""
-        if not values:
+        # Runs client-side: raw OpenAQ measurements are not staged in Postgres,
+        # so there is no table a SQL percentile_cont aggregate could run against
+        arr = np.asarray(values, dtype=np.float64)
+        if arr.size == 0:
             return None
         
-        # Simple outlier removal - remove top/bottom 5%
-        sorted_values = sorted(values)
-        trim_count = max(1, len(sorted_values) // 20)
-        trimmed = sorted_values[trim_count:-trim_count] if len(sorted_values) > 10 else sorted_values
-        
-        return sum(trimmed) / len(trimmed) if trimmed else None
+        return trimmed_mean(arr)
     
-    def update_supabase(self, region_code: str, air_quality_data: Dict[str, Optional[float]]):
-        """Update Supabase database with new air quality data"""
-        url = f"{self.supabase_url}/rest/v1/climate_inequality_regions"
-        
-        headers = {
-            'apikey': self.supabase_key,
-            'Authorization': f'Bearer {self.supabase_key}',
-            'Content-Type': 'application/json',
-            'Prefer': 'return=representation'
-        }
-        
+    def _build_update_data(
+        self,
+        air_quality_data: Dict[str, Optional[float]],
+        last_updated: str
+    ) -> Dict[str, object]:
+        """Build the column updates for a region, skipping missing readings"""
         update_data = {}
         if air_quality_data['avg_pm25'] is not None:
             update_data['air_quality_pm25'] = round(air_quality_data['avg_pm25'], 2)
         if air_quality_data['avg_no2'] is not None:
             update_data['air_quality_no2'] = round(air_quality_data['avg_no2'], 2)
         
+        if update_data:
+            update_data['last_updated'] = last_updated
+        
+        return update_data
+    
+    def update_supabase(
+        self,
+        region_code: str,
+        air_quality_data: Dict[str, Optional[float]],
+        last_updated: Optional[str] = None
+    ):
+        """Update Supabase database with new air quality data"""
+        url = f"{self.supabase_url}/rest/v1/climate_inequality_regions"
+        
+        if last_updated is None:
+            last_updated = datetime.utcnow().isoformat()
+        update_data = self._build_update_data(air_quality_data, last_updated)
+        
         if not update_data:
-            print(f"  ⚠ No data to update for {region_code}")
+            logger.warning("  ⚠ No data to update for %s", region_code)
             return
         
-        update_data['last_updated'] = datetime.utcnow().isoformat()
-        
         # Update using Supabase REST API
         params = {'region_code': f'eq.{region_code}'}
-        response = requests.patch(
+        response = self.session.patch(
             url, 
-            headers=headers, 
+            headers=self.supabase_headers, 
             params=params,
             json=update_data,
             timeout=10
         )
         
         if response.status_code in [200, 201, 204]:
-            print(f"  ✓ Updated database for {region_code}")
+            logger.info("  ✓ Updated database for %s", region_code)
         else:
-            print(f"  ✗ Failed to update {region_code}: {response.status_code} - {response.text}")
+            logger.error("  ✗ Failed to update %s: %s - %s", region_code, response.status_code, response.text)
+    
+    def bulk_update_supabase(
+        self,
+        air_quality_by_region: Dict[str, Dict[str, Optional[float]]],
+        last_updated: Optional[str] = None
+    ):
+        """
+        Update all regions in a single call to the bulk_update_air_quality RPC
+        
+        Falls back to per-region PATCH requests if the bulk update fails.
+        
+        Args:
+            air_quality_by_region: Air quality data keyed by region code
+            last_updated: ISO timestamp to record (None = now)
+        """
+        if last_updated is None:
+            last_updated = datetime.utcnow().isoformat()
+        
+        rows = []
+        for region_code, air_quality_data in air_quality_by_region.items():
+            update_data = self._build_update_data(air_quality_data, last_updated)
+            if update_data:
+                rows.append({'region_code': region_code, **update_data})
+            else:
+                logger.warning("  ⚠ No data to update for %s", region_code)
+        
+        if not rows:
+            return
+        
+        url = f"{self.supabase_url}/rest/v1/rpc/bulk_update_air_quality"
+        response = self.session.post(
+            url,
+            headers=self.supabase_headers,
+            json={'updates': rows},
+            timeout=30
+        )
+        
+        if response.status_code in [200, 201, 204]:
+            logger.info("  ✓ Updated database for %d regions", len(rows))
+            return
+        
+        logger.error("  ✗ Bulk update failed: %s - %s", response.status_code, response.text)
+        logger.info("  Falling back to per-region updates...")
+        
+        # Issue the fallback PATCHes concurrently so their round-trips overlap
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {
+                executor.submit(
+                    self.update_supabase,
+                    row['region_code'],
+                    air_quality_by_region[row['region_code']],
+                    last_updated
+                ): row['region_code']
+                for row in rows
+            }
+            
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error("  ✗ Failed to update %s: %s", futures[future], e)
     
     def run_etl(self, countries: Optional[List[str]] = None):
         """
@@ -196,44 +430,64 @@ class OpenAQETL:
         if countries is None:
             countries = list(COUNTRIES.keys())
         
-        print(f"\n{'='*60}")
-        print(f"OpenAQ ETL - Starting data fetch at {datetime.utcnow().isoformat()}")
-        print(f"{'='*60}\n")
+        # Format the run time and query window once for every fetch and update
+        run_started = datetime.utcnow()
+        run_timestamp = run_started.isoformat()
+        date_range = self._date_range(run_started, days_back=7)
+        
+        logger.info("\n%s", BANNER)
+        logger.info("OpenAQ ETL - Starting data fetch at %s", run_timestamp)
+        logger.info("%s\n", BANNER)
         
         successful = 0
         failed = 0
+        updates = {}
         
-        for country_code in countries:
-            country_name = COUNTRIES.get(country_code, country_code)
-            print(f"\n[{country_code}] Processing {country_name}...")
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {}
+            for country_code in countries:
+                country_name = COUNTRIES.get(country_code, country_code)
+                logger.info("[%s] Processing %s...", country_code, country_name)
+                future = executor.submit(self.fetch_country_air_quality, country_code, date_range=date_range)
+                futures[future] = country_code
             
-            try:
-                # Fetch air quality data
-                air_quality = self.fetch_country_air_quality(country_code)
+            for future in as_completed(futures):
+                country_code = futures[future]
                 
-                # Update database
-                if air_quality['avg_pm25'] or air_quality['avg_no2']:
-                    self.update_supabase(country_code, air_quality)
-                    successful += 1
-                else:
-                    print(f"  ⚠ No data available for {country_code}")
-                    failed += 1
+                try:
+                    # Fetch air quality data
+                    air_quality = future.result()
                     
-            except Exception as e:
-                print(f"  ✗ Error processing {country_code}: {str(e)}")
-                failed += 1
+                    # Queue for the batched database update
+                    if air_quality['avg_pm25'] or air_quality['avg_no2']:
+                        updates[country_code] = air_quality
+                        successful += 1
+                    else:
+                        logger.warning("  ⚠ No data available for %s", country_code)
+                        failed += 1
+                        
+                except Exception as e:
+                    logger.error("  ✗ Error processing %s: %s", country_code, e)
+                    failed += 1
         
-        print(f"\n{'='*60}")
-        print(f"ETL Complete: {successful} successful, {failed} failed")
-        print(f"{'='*60}\n")
+        # Update database
+        if updates:
+            logger.info("\nUpdating database for %d regions...", len(updates))
+            self.bulk_update_supabase(updates, run_timestamp)
+        
+        logger.info("\n%s", BANNER)
+        logger.info("ETL Complete: %d successful, %d failed", successful, failed)
+        logger.info("%s\n", BANNER)
 
 def main():
     """Main entry point"""
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    
     try:
-        etl = OpenAQETL()
-        etl.run_etl()
+        with OpenAQETL() as etl:
+            etl.run_etl()
     except Exception as e:
-        print(f"Fatal error: {str(e)}")
+        logger.error("Fatal error: %s", e)
         exit(1)
 
 if __name__ == "__main__":
@@ -0,0 +1,32 @@
+-- Bulk update air quality readings from the OpenAQ ETL in a single call
+-- NULL values keep the existing reading so partial results don't wipe data
+CREATE OR REPLACE FUNCTION public.bulk_update_air_quality(updates jsonb)
+RETURNS integer
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  updated_count integer;
+BEGIN
+  UPDATE climate_inequality_regions AS r
+  SET
+    air_quality_pm25 = COALESCE(u.air_quality_pm25, r.air_quality_pm25),
+    air_quality_no2 = COALESCE(u.air_quality_no2, r.air_quality_no2),
+    last_updated = COALESCE(u.last_updated, now())
+  FROM jsonb_to_recordset(updates) AS u(
+    region_code text,
+    air_quality_pm25 numeric,
+    air_quality_no2 numeric,
+    last_updated timestamp with time zone
+  )
+  WHERE r.region_code = u.region_code;
+
+  GET DIAGNOSTICS updated_count = ROW_COUNT;
+  RETURN updated_count;
+END;
+$$;
+
+-- Only the service role (used by the ETL) may write through this function
+REVOKE EXECUTE ON FUNCTION public.bulk_update_air_quality(jsonb) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.bulk_update_air_quality(jsonb) TO service_role;